@@ -29,15 +29,17 @@
 ###########################################################################
 
 import PyTango
-import time
+from functools import partial
 from sardana.pool.controller import (MotorController, Type, Description,
                                      DefaultValue)
 
 from sardana import State
+from sardana_linkam.ctrl.linkam_cache import AttributeCache, PendingRead
+from sardana_linkam.ctrl.linkam_device import LinkamDevice
 
 
 
-class LinkamT96MotorCtrl(MotorController):
+class LinkamT96MotorCtrl(LinkamDevice, MotorController):
     """This class is the Sardana motor controller for the device Linkam T96.
     The idea of this class is to be a generic motor controller for all the stages that
     are compatible with the idea of a motor controller.
@@ -57,10 +59,47 @@ class LinkamT96MotorCtrl(MotorController):
         3: 'axis_css_shearing'
     }
 
+    # Attributes read in StateAll/ReadAll for each supported axis
+    axis2state_attr = {
+        'axis_tst_stretcher': 'tst_stretching',
+        'axis_tst_temperature': 'heater_state'
+    }
+
+    axis2position_attr = {
+        'axis_tst_stretcher': 'tst_gap',
+        'axis_tst_temperature': 'temperature_t96'
+    }
+
+    # Attributes updated by change events, when the DS provides them.
+    # tst_stretching is only refreshed by the UpdateStateFlags command, so
+    # it is always read.
+    EVENT_ATTRS = ['heater_state', 'tst_gap', 'temperature_t96']
+
     AXIS_ATTR = ['PositionX', 'PositionY', 'PositionZ']
     ctrl_properties = {'DeviceName':
                       {Type: 'str',
-                       Description: 'Device name of the Linkam T-96 DS'}}
+                       Description: 'Device name of the Linkam T-96 DS'},
+                       'Timeout':
+                      {Type: int,
+                       Description: 'Timeout of the DS calls in ms',
+                       DefaultValue: 500}}
+
+    # State and status returned by StateOne
+    _ON = (State.On, '')
+    _MOVING = (State.Moving, '')
+    _FAULT = (State.Fault, 'DS communication problem')
+    _FAR_FROM_SETPOINT = (State.On, 'Current temperature far from setpoint')
+
+    heater_state2state = {
+        "Stopped" : _ON,
+        "Holding" : _ON,
+        "Alarm" : _FAR_FROM_SETPOINT,
+        "Running" : _MOVING
+    }
+
+    # Standard pool motor parameters, as passed by Sardana
+    _PARAMS = frozenset(['velocity', 'acceleration', 'deceleration',
+                         'step_per_unit', 'base_rate'])
 
     axis_attributes = {}
 
@@ -68,24 +107,63 @@ class LinkamT96MotorCtrl(MotorController):
 
         try:
             MotorController.__init__(self, inst, props, *args, **kwargs)
-            self.device = PyTango.DeviceProxy(self.DeviceName)
+            # The DS proxy is created on first use, see device
+            self._init_device()
             self.startMultiple = {}
+            self.stateMultiple = {}
+            # Set when the state could not be read in this tick
+            self._state_failed = False
             self.positionMultiple = {}
             self.attributes = {}
+            self.axes = []
+            self._update_axes_attrs()
+            self._cache = AttributeCache(self._read_attributes)
+            self._pending = PendingRead(self._cache, self.Timeout)
+            # Handlers of the standard pool motor parameters per axis.
+            # Parameters not listed (acceleration, deceleration and
+            # base_rate) are ignored on set.
+            self._setters = {
+                ('axis_tst_stretcher', 'velocity'):
+                    self._set_stretcher_velocity,
+                ('axis_tst_stretcher', 'step_per_unit'):
+                    self._set_stretcher_step_per_unit,
+                ('axis_tst_temperature', 'velocity'):
+                    self._set_temperature_rate,
+                ('axis_tst_temperature', 'step_per_unit'):
+                    partial(self._unsupported_par, 'step_per_unit')
+            }
+            self._getters = {
+                ('axis_tst_stretcher', 'velocity'):
+                    self._get_stretcher_velocity,
+                ('axis_tst_stretcher', 'step_per_unit'):
+                    self._get_stretcher_step_per_unit,
+                ('axis_tst_temperature', 'velocity'):
+                    self._get_temperature_rate,
+                ('axis_tst_temperature', 'step_per_unit'):
+                    partial(self._unsupported_par, 'step_per_unit')
+            }
 
         except Exception as e:
             self._log.error('Error when init: %s' % e)
             raise
 
+    def _read_attributes(self, names):
+        if 'tst_stretching' in names:
+            # Stretching flag is only refreshed in the DS on demand
+            self.device.UpdateStateFlags()
+        return [v.value for v in self.device.read_attributes(names)]
+
     def AddDevice(self, axis):
         self._log.debug('AddDevice entering...')
         axis_name = self.axis2motor[axis]
+        self._resubscribe()
+        self.axes.append(axis_name)
+        self._update_axes_attrs()
         if axis_name == "axis_tst_stretcher":
-            # Read current setted velocity from the Device
-            velocity = self.device.read_attribute("tst_motor_velocity").w_value
-            self.attributes[axis_name] = {'step_per_unit': velocity,
-                                          'velocity': 1}
-            
+            # The step_per_unit is set by the pool, or taken from the DS on
+            # first use, see _stretcher_attrs
+            self.attributes[axis_name] = {'velocity': 1}
+
         elif axis_name == "axis_tst_temperature":
             # We do not need to store any attribute for this axis
             pass
@@ -93,75 +171,191 @@ class LinkamT96MotorCtrl(MotorController):
     def DeleteDevice(self, axis):
         self._log.debug('DeleteDevice entering...')
         axis_name = self.axis2motor[axis]
+        if axis_name in self.axes:
+            self.axes.remove(axis_name)
+            self._update_axes_attrs()
         if axis_name == "axis_tst_stretcher":
             self.attributes[axis_name] = None
+        if not self.axes:
+            self._cache.unsubscribe()
+
+    def _stretcher_attrs(self):
+        attrs = self.attributes['axis_tst_stretcher']
+        if 'step_per_unit' not in attrs:
+            # Default to the current setted velocity of the Device
+            velocity = self.device.read_attribute("tst_motor_velocity").w_value
+            self._set_stretcher_step_per_unit(1, velocity)
+        return attrs
+
+    def _update_axes_attrs(self):
+        # Axes and attributes read in StateAll/ReadAll, rebuilt only when
+        # the axes change
+        self._state_axes = [name for name in self.axes
+                            if name in self.axis2state_attr]
+        self._state_attrs = [self.axis2state_attr[name]
+                             for name in self._state_axes]
+        self._position_axes = [name for name in self.axes
+                               if name in self.axis2position_attr]
+        self._position_attrs = [self.axis2position_attr[name]
+                                for name in self._position_axes]
+        # The positions are read with the state, so the position read after
+        # the end of a motion is not older than the state reporting it
+        self._poll_attrs = self._state_attrs + self._position_attrs
 
     def StateAll(self):
-        pass
+        """
+        Request State of all axes with a single asynchronous read of the
+        Tango attributes, the positions included. The reply is collected by
+        the first StateOne.
+        """
+        self._ensure_alive()
+        self.stateMultiple = None
+        self._state_failed = False
+        if not self._state_attrs:
+            return
+        attrs = self._poll_attrs
+        try:
+            if self._cache.needs_read(attrs):
+                if 'tst_stretching' in attrs:
+                    self.device.UpdateStateFlags()
+                self._pending.request(self.device, attrs)
+        except PyTango.DevFailed as e:
+            self._log.error('StateAll error: %s' % e)
+            self._dev_failed = True
+
+    def _read_state(self):
+        if not self._state_axes:
+            self.stateMultiple = {}
+            return
+        try:
+            self._pending.collect(self.device)
+            values = self._cache.read(self._poll_attrs)
+        except PyTango.DevFailed as e:
+            self._log.error('StateAll error: %s' % e)
+            self._dev_failed = True
+            self._state_failed = True
+            return
+        self.stateMultiple = dict(zip(self._state_axes, values))
 
     def StateOne(self, axis):
         axis_name = self.axis2motor[axis]
         self._log.debug('Entering StateOne for axis {} ({})'.format(axis, axis_name))
 
-        self.status = ""
+        # The state is read once per tick, also when it fails
+        if self.stateMultiple is None and not self._state_failed:
+            self._read_state()
 
-        if axis_name == 'axis_tst_stretcher':
-            self.device.UpdateStateFlags()
-            attribute = 'tst_stretching'
-            if self.device.read_attribute(attribute).value:
-                self.state = State.Moving
-            else:
-                self.state = State.On
+        if axis_name not in self.axis2state_attr:
+            return self._ON
 
-        elif axis_name == 'axis_tst_temperature':
-            attribute = 'heater_state'
-            state_mappings = {
-                "Stopped" : State.On,
-                "Holding" : State.On,
-                "Alarm" : State.On,
-                "Running" : State.Moving
-            }
-            state = self.device.read_attribute(attribute).value
-            self.state = state_mappings[state]
-            if state == "Alarm":
-                self.status = "Current temperature far from setpoint"
-                self._log.warning("Current temperature far from setpoint! It is taking too long to reach the setpoint.")
+        if self._state_failed or axis_name not in self.stateMultiple:
+            return self._FAULT
 
-        return self.state, self.status
+        value = self.stateMultiple[axis_name]
+        if axis_name == 'axis_tst_stretcher':
+            return self._MOVING if value else self._ON
+
+        state = self.heater_state2state[value]
+        if state is self._FAR_FROM_SETPOINT:
+            self._log.warning("Current temperature far from setpoint! It is taking too long to reach the setpoint.")
+        return state
 
     def ReadAll(self):
-        pass
+        self.positionMultiple = {}
+        if not self._position_axes:
+            return
+        self._pending.collect(self.device)
+        values = self._cache.read(self._position_attrs)
+        for name, value in zip(self._position_axes, values):
+            self.positionMultiple[name] = value
 
     def ReadOne(self, axis):
         axis_name = self.axis2motor[axis]
         self._log.debug('Entering ReadOne for axis {} ({})'.format(axis, axis_name))
-        
-        if axis_name == 'axis_tst_stretcher':
-            attr = 'tst_gap'
-            value = self.device.read_attribute(attr).value
-            value = value / self.attributes[axis_name]['step_per_unit']
 
-        elif axis_name == 'axis_tst_temperature':
-            attr = 'temperature_t96'
-            value = self.device.read_attribute(attr).value
+        value = self.positionMultiple[axis_name]
+        if axis_name == 'axis_tst_stretcher':
+            value = value * self._stretcher_attrs()['_inv_spu']
 
         return value
 
+    def PreStartAll(self):
+        self.startMultiple = {}
+
     def StartOne(self, axis, position):
         axis_name = self.axis2motor[axis]
         self._log.debug('Entering StartOne for axis {} ({})'.format(axis, axis_name))
 
         if axis_name == 'axis_tst_stretcher':
-            position = position * self.attributes[axis_name]['step_per_unit']
+            position = position * self._stretcher_attrs()['step_per_unit']
             cmd = 'MoveGapAbsolute'
 
         elif axis_name == 'axis_tst_temperature':
             cmd = 'StartTemperatureRamp'
 
-        self.device.command_inout(cmd, position)
+        self.startMultiple[axis_name] = (cmd, position)
 
     def StartAll(self):
-        pass
+        # Send all the commands before waiting for any reply, so several
+        # axes moved together do not wait for each other
+        ids = []
+        errors = []
+        try:
+            for cmd, position in self.startMultiple.values():
+                ids.append(self.device.command_inout_asynch(cmd, position))
+        finally:
+            self._cache.invalidate()
+            # Every reply is collected, also after a failure of another axis
+            for aid in ids:
+                try:
+                    self.device.command_inout_reply(aid, self.Timeout)
+                except PyTango.DevFailed as e:
+                    self._log.error('StartAll error: %s' % e)
+                    errors.append(e)
+                    # Not consumed if the reply did not arrive in time
+                    try:
+                        self.device.cancel_asynch_request(aid)
+                    except Exception:
+                        pass
+        if errors:
+            raise errors[0]
+
+    def _set_stretcher_velocity(self, axis, value):
+        attrs = self._stretcher_attrs()
+        attr = 'tst_motor_velocity'
+        velocity = int(value * attrs['step_per_unit'])
+        self.device.write_attribute(attr, velocity)
+        attrs['velocity'] = velocity
+
+    def _get_stretcher_velocity(self, axis):
+        attrs = self._stretcher_attrs()
+        # Return memorized attribute because reading of the Tango DS attribute
+        # is sometimes incorrect when we set a new velocity. 
+        # It only gets correctly updated in the DS once you move the motor.
+        return attrs['velocity'] / attrs['step_per_unit']
+
+    def _set_stretcher_step_per_unit(self, axis, value):
+        axis_name = self.axis2motor[axis]
+        value = float(value)
+        if value == 0:
+            raise ValueError('step_per_unit cannot be 0')
+        self.attributes[axis_name]["step_per_unit"] = value
+        # Reciprocal used to convert read positions
+        self.attributes[axis_name]["_inv_spu"] = 1.0 / value
+
+    def _get_stretcher_step_per_unit(self, axis):
+        return self._stretcher_attrs()["step_per_unit"]
+
+    def _set_temperature_rate(self, axis, value):
+        attr = 'temperature_rate'
+        self.device.write_attribute(attr, value)
+
+    def _get_temperature_rate(self, axis):
+        return self.device.read_attribute("temperature_rate").value
+
+    def _unsupported_par(self, name, axis, *args):
+        axis_name = self.axis2motor[axis]
+        raise Exception("{} is not supported for axis {} ({})".format(name, axis, axis_name))
 
     def SetAxisPar(self, axis, name, value):
         """ Set the standard pool motor parameters.
@@ -169,30 +363,11 @@ class LinkamT96MotorCtrl(MotorController):
         @param name of the parameter
         @param value to be set
         """
-        name = name.lower()
-        axis_name = self.axis2motor[axis]
-
-        if name == 'velocity':
-            if axis_name == 'axis_tst_stretcher':
-                attr = 'tst_motor_velocity'
-                velocity = int(value * self.attributes[axis_name]['step_per_unit'])
-                self.device.write_attribute(attr, velocity)
-                self.attributes[axis_name]['velocity'] = velocity
-
-            elif axis_name == 'axis_tst_temperature':
-                attr = 'temperature_rate'
-                self.device.write_attribute(attr, value)
-
-        elif name == "step_per_unit":
-            if axis_name == 'axis_tst_stretcher':
-                self.attributes[axis_name]["step_per_unit"] = float(value)
-
-            elif axis_name == 'axis_tst_temperature':
-                raise Exception("{} is not supported for axis {} ({})".format(name, axis, axis_name))
-
-        elif name in ['acceleration', 'deceleration', 'base_rate']:
-            if axis in ['axis_tst_stretcher', 'axis_tst_temperature']:
-                raise Exception("{} does not support {}".format(self.__class__.__name__, name))
+        if name not in self._PARAMS:
+            name = name.lower()
+        setter = self._setters.get((self.axis2motor[axis], name))
+        if setter is not None:
+            setter(axis, value)
 
     def GetAxisPar(self, axis, name):
         """ Get the standard pool motor parameters.
@@ -200,32 +375,12 @@ class LinkamT96MotorCtrl(MotorController):
         @param name of the parameter to get the value
         @return the value of the parameter
         """
-
-        name = name.lower()
-        axis_name = self.axis2motor[axis]
-        
-        if name == 'velocity':
-            if axis_name == 'axis_tst_stretcher':
-                # Return memorized attribute because reading of the Tango DS attribute
-                # is sometimes incorrect when we set a new velocity. 
-                # It only gets correctly updated in the DS once you move the motor.
-                value = self.attributes[axis_name]['velocity'] / self.attributes[axis_name]['step_per_unit']
-                
-            elif axis_name == 'axis_tst_temperature':
-                value = self.device.read_attribute("temperature_rate").value
-
-        elif name == "step_per_unit":
-            if axis_name == 'axis_tst_stretcher':
-                value = self.attributes[axis_name]["step_per_unit"]
-
-            elif axis_name == 'axis_tst_temperature':
-                raise Exception("{} is not supported for axis {} ({})".format(name, axis, axis_name))
-
-        elif name in ['acceleration', 'deceleration', 'base_rate']:
-            if axis in ['axis_tst_stretcher', 'axis_tst_temperature']:
-                raise Exception("{} does not support {}".format(self.__class__.__name__, name))
-
-        return value
+        if name not in self._PARAMS:
+            name = name.lower()
+        getter = self._getters.get((self.axis2motor[axis], name))
+        if getter is None:
+            raise Exception("{} does not support {}".format(self.__class__.__name__, name))
+        return getter(axis)
 
     def AbortOne(self, axis):
         axis_name = self.axis2motor[axis]
@@ -236,4 +391,5 @@ class LinkamT96MotorCtrl(MotorController):
             cmd = 'HoldTemp'
 
         self.device.command_inout(cmd)
+        self._cache.invalidate()
 
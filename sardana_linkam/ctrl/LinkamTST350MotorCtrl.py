@@ -29,15 +29,18 @@
 ###########################################################################
 
 import PyTango
-import time
+from functools import partial
+import numpy as np
 from sardana.pool.controller import (MotorController, Type, Description,
                                      DefaultValue)
 
 from sardana import State
+from sardana_linkam.ctrl.linkam_cache import AttributeCache, PendingRead
+from sardana_linkam.ctrl.linkam_device import LinkamDevice
 
 
 
-class LinkamTST350MotorCtrl(MotorController):
+class LinkamTST350MotorCtrl(LinkamDevice, MotorController):
     """This class is the Sardana motor controller for the Linkam TST350
     motor controller device. It is designed to work linked to the TangoDS
     XXXX.
@@ -50,9 +53,25 @@ class LinkamTST350MotorCtrl(MotorController):
     MaxDevice = 3
 
     AXIS_ATTR = ['PositionX', 'PositionY', 'PositionZ']
+    STATE_ATTRS = ['Idle'] + AXIS_ATTR
+    # Attributes updated by change events, when the DS provides them
+    EVENT_ATTRS = STATE_ATTRS
     ctrl_properties = {'DeviceName':
                       {Type: 'str',
-                       Description: 'Device name of the Smaract MCS DS'}}
+                       Description: 'Device name of the Smaract MCS DS'},
+                       'Timeout':
+                      {Type: int,
+                       Description: 'Timeout of the DS calls in ms',
+                       DefaultValue: 500}}
+
+    # State and status returned by StateOne
+    _ON = (State.On, 'ON')
+    _MOVING = (State.Moving, 'Moving')
+    _FAULT = (State.Fault, 'DS communication problem')
+
+    # Standard pool motor parameters, as passed by Sardana
+    _PARAMS = frozenset(['velocity', 'acceleration', 'deceleration',
+                         'step_per_unit', 'base_rate'])
 
     axis_attributes = {}
 
@@ -60,80 +79,139 @@ class LinkamTST350MotorCtrl(MotorController):
 
         try:
             MotorController.__init__(self, inst, props, *args, **kwargs)
-            self.device = PyTango.DeviceProxy(self.DeviceName)
+            # The DS proxy is created on first use, see device
+            self._init_device()
             self.startMultiple = {}
+            # Velocities to be written to the DS by axes group
+            self._pending_speeds = {}
             self.positionMultiple = {}
-            self.attributes = {}
+            # Axis parameters, indexed by axis - 1
+            self.axes = []
+            self._spu = np.ones(self.MaxDevice)
+            # Reciprocal of step_per_unit, used to convert read positions
+            self._inv_spu = np.ones(self.MaxDevice)
+            self._vel = np.ones(self.MaxDevice)
+            self._accel = np.zeros(self.MaxDevice)
+            self._base_rate = np.zeros(self.MaxDevice)
+            # Dispatch tables of the standard pool motor parameters
+            self._setters = {
+                'velocity': self._set_velocity,
+                'acceleration': partial(self._set_par, self._accel),
+                'deceleration': partial(self._set_par, self._accel),
+                'step_per_unit': self._set_step_per_unit,
+                'base_rate': partial(self._set_par, self._base_rate)
+            }
+            # Values returned by GetAxisPar by (axis, name), until the next
+            # SetAxisPar of the axis
+            self._par_cache = {}
+            self._getters = {
+                'velocity': self._get_velocity,
+                'acceleration': partial(self._get_par, self._accel),
+                'deceleration': partial(self._get_par, self._accel),
+                'step_per_unit': partial(self._get_par, self._spu),
+                'base_rate': partial(self._get_par, self._base_rate)
+            }
+            self._cache = AttributeCache(self._read_attributes)
+            self._pending = PendingRead(self._cache, self.Timeout)
+            self.idle = None
+            # Set when the state could not be read in this tick
+            self._state_failed = False
 
         except Exception as e:
             self._log.error('Error when init: %s' % e)
             raise
 
+    def _read_attributes(self, names):
+        return [v.value for v in self.device.read_attributes(names)]
+
     def AddDevice(self, axis):
         self._log.debug('AddDevice entering...')
-        self.attributes[axis] = {'step_per_unit': 1.0,
-                                 'base_rate': 0,
-                                 'acceleration': 0,
-                                 'velocity': 1}
+        self.axes.append(axis)
+        self._resubscribe()
+        self._spu[axis-1] = 1.0
+        self._inv_spu[axis-1] = 1.0
+        self._vel[axis-1] = 1
+        self._accel[axis-1] = 0
+        self._base_rate[axis-1] = 0
+        self._clear_par_cache(axis)
 
     def DeleteDevice(self, axis):
-        self.attributes[axis] = None
+        self.axes.remove(axis)
+        if not self.axes:
+            self._cache.unsubscribe()
 
     def StateAll(self):
         """
-        Get State of all axes
+        Request State of all axes. The positions are read in the same request,
+        so ReadAll is served from the cache while the reply is fresh. The
+        reply is collected by the first StateOne.
         """
+        self._ensure_alive()
         self.idle = None
+        self._state_failed = False
         try:
-            self.idle = self.device.read_attribute('Idle').value
-        except Exception as e:
+            if self._cache.needs_read(self.STATE_ATTRS):
+                self._pending.request(self.device, self.STATE_ATTRS)
+        except PyTango.DevFailed as e:
             self._log.error('StateAll error: %s' % e)
-            self.state = State.Fault
-            self.status = 'DS communication problem'
+            self._dev_failed = True
+
+    def _read_state(self):
+        try:
+            self._pending.collect(self.device)
+            values = self._cache.read(self.STATE_ATTRS)
+        except PyTango.DevFailed as e:
+            self._log.error('StateAll error: %s' % e)
+            self._dev_failed = True
+            self._state_failed = True
             return
+        self.idle = values[0]
 
     def StateOne(self, axis):
-        if self.idle != None:
-            axis_idle = self.idle[axis-1]
-            if axis_idle:
-                self.state = State.On
-                self.status = 'ON'
-            else:
-                self.state = State.Moving
-                self.status = 'Moving'
-
-        return self.state, self.status
+        # The state is read once per tick, also when it fails
+        if self.idle is None and not self._state_failed:
+            self._read_state()
+        if self.idle is None:
+            return self._FAULT
+        if self.idle[axis-1]:
+            return self._ON
+        return self._MOVING
 
     def ReadAll(self):
-        self.positionMultiple = {}
-        for axis in list(self.attributes.keys()):
-            attr = self.AXIS_ATTR[axis-1]
-            value = self.device.read_attribute(attr).value
-            pos = value / self.attributes[axis]['step_per_unit']
-            self.positionMultiple[axis] = pos
+        self._pending.collect(self.device)
+        values = self._cache.read(self.AXIS_ATTR)
+        positions = np.asarray(values, dtype=np.float64) * self._inv_spu
+        self.positionMultiple = {axis: positions[axis-1]
+                                 for axis in self.axes}
 
     def ReadOne(self, axis):
         return self.positionMultiple[axis]
 
     def PreStartAll(self):
         self.startMultiple = {}
+        self._flush_speeds()
 
     def StartOne(self, axis, position):
-
-        position = position * self.attributes[axis]['step_per_unit']
         self.startMultiple[axis] = position
 
     def StartAll(self):
-        positions_list = []
-
-        for i in range(3):
-            if i+1 in self.startMultiple:
-                pos = self.startMultiple[i+1]
-            else:
-                attr = self.AXIS_ATTR[i]
-                pos = self.device.read_attribute(attr).value
-            positions_list.append(int(pos))
+        # Target positions in steps of the axes being moved
+        steps = np.empty(3)
+        moving = [axis-1 for axis in self.startMultiple]
+        targets = np.array(list(self.startMultiple.values()), dtype=np.float64)
+        steps[moving] = targets * self._spu[moving]
+
+        # Axes not being moved keep their current position, read at once
+        missing = [i for i in range(3) if i+1 not in self.startMultiple]
+        if missing:
+            attrs = [self.AXIS_ATTR[i] for i in missing]
+            values = self.device.read_attributes(attrs)
+            steps[missing] = [v.value for v in values]
+
+        positions_list = steps.astype(np.int64).tolist()
+        self._log.debug("MoveAbsolute positions: %s" % str(positions_list))
         self.device.command_inout('MoveAbsolute', positions_list)
+        self._cache.invalidate()
         idle = [True, True, True]
         count = 0
         while all(idle) and count < 20:
@@ -141,31 +219,53 @@ class LinkamTST350MotorCtrl(MotorController):
             count += 1
         self._log.debug("Idle state is %s" % str(idle))
 
+    def _set_velocity(self, axis, value):
+        velocity = int(value * self._spu[axis-1])
+        # X and Y share the same speed, the last one set is written to the DS
+        # on the next PreStartAll
+        group = 'xy' if axis in [1, 2] else 'z'
+        self._pending_speeds[group] = velocity
+        self._vel[axis-1] = velocity
+
+    def _flush_speeds(self):
+        # Each speed is dropped only once written, a failed one is retried
+        # on the next flush
+        speeds = self._pending_speeds
+        if 'xy' in speeds:
+            self.device.command_inout('SetSpeedXY', speeds['xy'])
+            del speeds['xy']
+        if 'z' in speeds:
+            self.device.write_attribute('SpeedZ', speeds['z'])
+            del speeds['z']
+
+    def _get_velocity(self, axis):
+        return self._vel[axis-1] / self._spu[axis-1]
+
+    def _set_step_per_unit(self, axis, value):
+        value = float(value)
+        if value == 0:
+            raise ValueError('step_per_unit cannot be 0')
+        self._spu[axis-1] = value
+        self._inv_spu[axis-1] = 1.0 / value
+
+    def _set_par(self, par, axis, value):
+        par[axis-1] = float(value)
+
+    def _get_par(self, par, axis):
+        return par[axis-1]
+
     def SetAxisPar(self, axis, name, value):
         """ Set the standard pool motor parameters.
         @param axis to set the parameter
         @param name of the parameter
         @param value to be set
         """
-        name = name.lower()
-        if name == 'velocity':
-            velocity = int(value * self.attributes[axis]['step_per_unit'])
-            if axis in [0, 1]:
-                cmd = 'SetSpeedXY'
-                self.device.command_inout(cmd, velocity)
-            else:
-                attr = 'SpeedZ'
-                self.device.write_attribute(attr, velocity)
-            self.attributes[axis]['velocity'] = velocity
-
-        elif name in ['acceleration', 'deceleration']:
-            self.attributes[axis]['acceleration'] = value
-
-        elif name == "step_per_unit":
-            self.attributes[axis]["step_per_unit"] = float(value)
-
-        elif name == "base_rate":
-            self.attributes[axis]["base_rate"] = float(value)
+        if name not in self._PARAMS:
+            name = name.lower()
+        setter = self._setters.get(name)
+        if setter is not None:
+            setter(axis, value)
+            self._clear_par_cache(axis)
 
     def GetAxisPar(self, axis, name):
         """ Get the standard pool motor parameters.
@@ -173,28 +273,26 @@ class LinkamTST350MotorCtrl(MotorController):
         @param name of the parameter to get the value
         @return the value of the parameter
         """
+        if name not in self._PARAMS:
+            name = name.lower()
+        key = (axis, name)
+        try:
+            return self._par_cache[key]
+        except KeyError:
+            value = self._par_cache[key] = self._getters[name](axis)
+            return value
 
-        name = name.lower()
-        if name == 'velocity':
-            value = self.attributes[axis]['velocity'] / self.attributes[
-                axis]['step_per_unit']
-
-        elif name in ['acceleration', 'deceleration']:
-            value = self.attributes[axis]['acceleration']
-
-        elif name == "step_per_unit":
-            value = self.attributes[axis]["step_per_unit"]
-
-        elif name == "base_rate":
-            value = self.attributes[axis]["base_rate"]
-
-        return value
+    def _clear_par_cache(self, axis):
+        # The velocity depends on the step_per_unit, drop the whole axis
+        for key in [key for key in self._par_cache if key[0] == axis]:
+            del self._par_cache[key]
 
     def AbortOne(self, axis):
-        if axis in [0, 1]:
+        if axis in [1, 2]:
             cmd = 'StopXY'
         else:
             cmd = 'StopZ'
 
         self.device.command_inout(cmd)
+        self._cache.invalidate()
 
@@ -32,9 +32,11 @@ import PyTango
 from sardana.pool.controller import (MotorController, Type, Description,
                                      DefaultValue)
 from sardana import State
+from sardana_linkam.ctrl.linkam_cache import AttributeCache, PendingRead
+from sardana_linkam.ctrl.linkam_device import LinkamDevice
 
 
-class LinkamTST350TempMotorCtrl(MotorController):
+class LinkamTST350TempMotorCtrl(LinkamDevice, MotorController):
     """This class is the Sardana motor controller for the Linkam TST350
     temperature controller device.
 
@@ -51,9 +53,46 @@ class LinkamTST350TempMotorCtrl(MotorController):
 
     MaxDevice = 1
     AXIS_ATTR = 'Temperature'
+    STATE_ATTRS = ['IdleT', 'ErrorMsg', 'Program']
+    # The temperature is read together with the state, so ReadOne is served
+    # from the same request
+    POLL_ATTRS = STATE_ATTRS + [AXIS_ATTR]
+    # Attributes updated by change events, when the DS provides them
+    EVENT_ATTRS = POLL_ATTRS
+    # Commands sent by the controller, queried once on connection
+    COMMANDS = ['StartRamp', 'HoldTemp']
     ctrl_properties = {'DeviceName':
                       {Type: 'str',
-                       Description: 'Device name of the Linkam TST350'}}
+                       Description: 'Device name of the Linkam TST350'},
+                       'Timeout':
+                      {Type: int,
+                       Description: 'Timeout of the DS calls in ms',
+                       DefaultValue: 500},
+                       'CacheTTL':
+                      {Type: float,
+                       Description: 'Seconds the DS values are reused '
+                                    'before reading them again, 0 reads '
+                                    'them every time',
+                       DefaultValue: 0.2},
+                       'UsePollingCache':
+                      {Type: bool,
+                       Description: 'Read from the DS polling buffer when the '
+                                    'attributes are polled by the DS',
+                       DefaultValue: False}}
+
+    # Seconds the temperature returned by ReadOne is reused by StartOne
+    CURRENT_TEMP_AGE = 1.0
+
+    # Standard pool motor parameters, as passed by Sardana
+    _PARAMS = frozenset(['velocity', 'acceleration', 'deceleration',
+                         'step_per_unit', 'base_rate'])
+    # Controller attribute holding each standard pool motor parameter of
+    # the single axis
+    _PAR_MAP = {'velocity': '_velocity',
+                'acceleration': '_acceleration',
+                'deceleration': '_acceleration',
+                'step_per_unit': '_step_per_unit',
+                'base_rate': '_base_rate'}
 
     axis_attributes = {
         "tolerance" : {
@@ -67,95 +106,141 @@ class LinkamTST350TempMotorCtrl(MotorController):
 
         self._target_temp = None
         self._current_temp = None
+        self._current_temp_ts = 0
         self._move_timeout = float('inf')
         try:
             MotorController.__init__(self, inst, props, *args, **kwargs)
-            self.device = PyTango.DeviceProxy(self.DeviceName)
-            self.attributes = {}
+            # The DS proxy is created on first use, see device
+            self._init_device()
+            # Parameters of the single axis, set in AddDevice
+            self._step_per_unit = 1.0
+            self._inv_spu = 1.0
+            self._base_rate = 0
+            self._acceleration = 0
+            self._velocity = 1.
+            self._tolerance = 0
+            self._cache = AttributeCache(self._read_attributes,
+                                         fresh=self.CacheTTL,
+                                         stale=self.CacheTTL)
+            self._pending = PendingRead(self._cache, self.Timeout)
 
         except Exception as e:
             self._log.error('Error when init: %s' % e)
             raise
 
+    def _setup_device(self, device):
+        # Read from the device unless the DS polls IdleT, ErrorMsg, Program
+        # and Temperature, then its polling buffer is used while it is fresh
+        if self.UsePollingCache:
+            device.set_source(PyTango.DevSource.CACHE_DEV)
+        else:
+            device.set_source(PyTango.DevSource.DEV)
+        # Query the command configuration in advance so the first
+        # StartRamp or HoldTemp (in an abort) does not pay for it
+        try:
+            device.get_command_config(self.COMMANDS)
+        except PyTango.DevFailed as e:
+            self._log.debug('Cannot query the commands: %s' % e)
+
+    def _read_attributes(self, names):
+        return [v.value for v in self.device.read_attributes(names)]
+
     def AddDevice(self, axis):
         self._log.debug('Adding device...')
-        self.attributes[axis] = {'step_per_unit': 1.0,
-                                 'base_rate': 0,
-                                 'acceleration': 0,
-                                 'velocity': 1.,
-                                 'tolerance': 0}
+        self._resubscribe()
+        self._step_per_unit = 1.0
+        self._inv_spu = 1.0
+        self._base_rate = 0
+        self._acceleration = 0
+        self._velocity = 1.
+        self._tolerance = 0
 
     def DeleteDevice(self, axis):
-        self.attributes[axis] = None
+        self._cache.unsubscribe()
+
+    def StateAll(self):
+        """
+        Request the state attributes and the temperature, the reply is
+        collected in StateOne
+        """
+        self._ensure_alive()
+        try:
+            if self._cache.needs_read(self.POLL_ATTRS):
+                self._pending.request(self.device, self.POLL_ATTRS)
+        except PyTango.DevFailed as e:
+            self._log.error('StateAll error: %s' % e)
+            self._dev_failed = True
 
     def StateOne(self, axis):
         try:
-            idle = self.device.read_attribute('IdleT').value
-            error = self.device.read_attribute('ErrorMsg').value
-            program = self.device.read_attribute('Program').value
-        except Exception as e:
+            self._pending.collect(self.device)
+            idle, error, program, _ = self._cache.read(self.POLL_ATTRS)
+        except PyTango.DevFailed as e:
             self._log.error('StateOne error: %s' % e)
+            self._dev_failed = True
             self.state = State.Fault
             self.status = 'DS communication problem'
             return self.state, self.status
 
         if error == "No_error":
+            if time.monotonic() >= self._move_timeout:
+                self.state = State.Alarm
+                self.status = 'Motor did not reach the desired position.'
+                return self.state, self.status
+
             if idle:
-                if time.time() < self._move_timeout:
-                    self.state = State.Moving
-                else:
-                    self.state = State.Alarm
-                    self.status = 'Motor did not reach the desired position.'
-                    return self.state, self.status
-                    
-                if (self._target_temp is not None
-                    and self._current_temp is not None
-                    and self.attributes[axis]["tolerance"] > 0):
-                    
-                    diff_temp = abs(self._target_temp - self._current_temp)
-                    if self.attributes[axis]["tolerance"] >= diff_temp:
-                        self._target_temp = None
-                        self._move_timeout = float('inf')
-                        #self.device.command_inout('HoldTemp')
-                        self.state = State.On
-                else:
+                tol = self._tolerance
+                tgt = self._target_temp
+                cur = self._current_temp
+                if tgt is None or cur is None or tol <= 0:
+                    self.state = State.On
+                elif abs(tgt - cur) <= tol:
+                    self._target_temp = None
+                    self._move_timeout = float('inf')
+                    #self.device.command_inout('HoldTemp')
                     self.state = State.On
-            else:
-                if time.time() < self._move_timeout:
-                    self.state = State.Moving
                 else:
-                    self.state = State.Alarm
-                    self.status = 'Motor did not reach the desired position.'
-                    return self.state, self.status
+                    self.state = State.Moving
+            else:
+                self.state = State.Moving
         else:
             self.state = State.Fault
         self.status = program
-        
+
         return self.state, self.status
 
     def ReadOne(self, axis):
         attr = self.AXIS_ATTR
-        value = self.device.read_attribute(attr).value
-        temp = value / self.attributes[axis]['step_per_unit']
+        value, = self._cache.read([attr])
+        temp = value * self._inv_spu
         self._current_temp = temp
+        self._current_temp_ts = time.monotonic()
         return temp
 
     def StartOne(self, axis, temperature):
         self._target_temp = temperature
-        temperature = temperature * self.attributes[axis]['step_per_unit']
-        velocity = self.attributes[axis]['velocity']
-        
-        _delta_t = abs(self.ReadOne(axis) - temperature)
+        temperature = temperature * self._step_per_unit
+        velocity = self._velocity
+
+        # The pool reads the position just before starting the motion
+        if (time.monotonic() - self._current_temp_ts) < self.CURRENT_TEMP_AGE:
+            current = self._current_temp
+        else:
+            current = self.ReadOne(axis)
+        _delta_t = abs(current - temperature)
         # _time is the ramp time in seconds. Velocity is in deg/min
-        _time = _delta_t / self.attributes[axis]['velocity'] * 60.0
-        
+        _time = _delta_t / velocity * 60.0
+
+        # The DS rate is written as velocity * 60, as it always has been
         self.device.command_inout('StartRamp', [velocity * 60, temperature])
+        self._cache.invalidate()
         # Calculate theoretical movement time + startup + tolerance
         startup = 30
-        self._move_timeout = time.time() + _time * 2 + startup
+        self._move_timeout = time.monotonic() + _time * 2 + startup
 
     def AbortOne(self, axis):
         self.device.command_inout('HoldTemp')
+        self._cache.invalidate()
         self._target_temp = None
 
     def SetAxisPar(self, axis, name, value):
@@ -164,18 +249,17 @@ class LinkamTST350TempMotorCtrl(MotorController):
         @param name of the parameter
         @param value to be set
         """
-        name = name.lower()
-        if name == 'velocity':
-            self.attributes[axis]['velocity'] = float(value)
-
-        elif name in ['acceleration', 'deceleration']:
-            self.attributes[axis]['acceleration'] = float(value)
-
-        elif name == "step_per_unit":
-            self.attributes[axis]["step_per_unit"] = float(value)
-
-        elif name == "base_rate":
-            self.attributes[axis]["base_rate"] = float(value)
+        if name not in self._PARAMS:
+            name = name.lower()
+        key = self._PAR_MAP.get(name)
+        if key is not None:
+            value = float(value)
+            if key == '_step_per_unit':
+                if value == 0:
+                    raise ValueError('step_per_unit cannot be 0')
+                # Reciprocal used to convert read temperatures
+                self._inv_spu = 1.0 / value
+            setattr(self, key, value)
 
     def GetAxisPar(self, axis, name):
         """ Get the standard pool motor parameters.
@@ -183,25 +267,14 @@ class LinkamTST350TempMotorCtrl(MotorController):
         @param name of the parameter to get the value
         @return the value of the parameter
         """
-        name = name.lower()
-        if name == 'velocity':
-            value = self.attributes[axis]['velocity']
-
-        elif name in ['acceleration', 'deceleration']:
-            value = self.attributes[axis]['acceleration']
-
-        elif name == "step_per_unit":
-            value = self.attributes[axis]["step_per_unit"]
-
-        elif name == "base_rate":
-            value = self.attributes[axis]["base_rate"]
-        
-        return value
+        if name not in self._PARAMS:
+            name = name.lower()
+        return getattr(self, self._PAR_MAP[name])
 
     def SetAxisExtraPar(self, axis, parameter, value):
         if parameter == 'tolerance':
-            self.attributes[axis]["tolerance"]  = float(value)
+            self._tolerance = float(value)
   
     def GetAxisExtraPar(self, axis, parameter):
         if parameter == 'tolerance':
-            return self.attributes[axis]["tolerance"]
+            return self._tolerance
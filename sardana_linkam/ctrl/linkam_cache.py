@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+## file :    linkam_cache.py
+##
+## developers : ctbeamlines@cells.es
+##
+## copyleft :    Cells / Alba Synchrotron
+##               Bellaterra
+##               Spain
+##
+#############################################################################
+##
+## This file is part of Sardana.
+##
+## This is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This software is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, see <http://www.gnu.org/licenses/>.
+###########################################################################
+import threading
+import time
+from functools import partial
+import PyTango
+
+
+class AttributeCache(object):
+    """Stale-while-revalidate cache of Tango attribute values shared by the
+    Linkam controllers.
+
+    Values younger than `fresh` seconds are returned directly. Values younger
+    than `stale` seconds are returned as well, but a background thread is
+    started to refresh them. Missing or older values are read synchronously.
+    Concurrent reads of the same attribute share a single device request.
+
+    Attributes subscribed to change events are updated by the events and
+    their values are considered fresh for `event_timeout` seconds instead,
+    after which they are read again as any other attribute.
+
+    The reader is a callable receiving a list of attribute names and
+    returning the list of their values.
+    """
+
+    def __init__(self, reader, fresh=0.1, stale=1.0, event_timeout=3.0):
+        self._reader = reader
+        self.fresh = fresh
+        self.stale = stale
+        self.event_timeout = event_timeout
+        self._values = {}
+        # Attributes updated by change events and their subscriptions
+        self._pushed = set()
+        self._subscriptions = []
+        # Event of the device request in progress for each attribute
+        self._inflight = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def read(self, names):
+        """Return the values of the given attributes, in the same order."""
+        now = time.monotonic()
+        missing, stale = [], []
+        with self._lock:
+            for name in names:
+                entry = self._values.get(name)
+                fresh, stale_ttl = self._ttl(name)
+                if entry is None or now - entry[1] >= stale_ttl:
+                    missing.append(name)
+                elif (now - entry[1] >= fresh
+                      and name not in self._inflight):
+                    stale.append(name)
+            values = {name: self._values[name][0] for name in names
+                      if name not in missing}
+            if stale:
+                flight = self._start_flight(stale)
+
+        if stale:
+            thread = threading.Thread(target=self._refresh,
+                                      args=(stale, flight))
+            thread.daemon = True
+            thread.start()
+        if missing:
+            values.update(self._fetch(missing))
+        return [values[name] for name in names]
+
+    @property
+    def generation(self):
+        """Counter increased on every invalidation."""
+        return self._generation
+
+    def needs_read(self, names):
+        """Return True if reading the given attributes would block on the
+        device, i.e. any of them is missing or older than `stale`.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for name in names:
+                entry = self._values.get(name)
+                if entry is None or now - entry[1] >= self._ttl(name)[1]:
+                    return True
+        return False
+
+    def update(self, names, values, generation=None):
+        """Store values read from the device. They are discarded if the
+        cache was invalidated after `generation`.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if generation is None or generation == self._generation:
+                for name, value in zip(names, values):
+                    self._values[name] = (value, now)
+
+    def subscribe(self, device, names):
+        """Subscribe to the change events of the given attributes of the
+        device. Return the subscription errors by attribute name, those
+        attributes keep being read from the device.
+        """
+        errors = {}
+        for name in names:
+            try:
+                eid = device.subscribe_event(
+                    name, PyTango.EventType.CHANGE_EVENT,
+                    partial(self.push_event, name))
+            except PyTango.DevFailed as e:
+                errors[name] = e
+            else:
+                self._subscriptions.append((device, eid))
+        return errors
+
+    @property
+    def subscribed(self):
+        """True if any change event subscription is active."""
+        return bool(self._subscriptions)
+
+    def unsubscribe(self):
+        """Cancel all the event subscriptions, the attributes are read from
+        the device from now on.
+        """
+        subscriptions, self._subscriptions = self._subscriptions, []
+        for device, eid in subscriptions:
+            try:
+                device.unsubscribe_event(eid)
+            except PyTango.DevFailed:
+                pass
+        with self._lock:
+            self._pushed.clear()
+
+    def push_event(self, name, event):
+        """Callback of the change events of an attribute."""
+        if event.err:
+            return
+        with self._lock:
+            self._pushed.add(name)
+            self._values[name] = (event.attr_value.value, time.monotonic())
+
+    def invalidate(self, names=None):
+        """Drop the given attributes (all of them by default) so the next
+        read goes to the device. Refreshes already in flight are discarded.
+        """
+        with self._lock:
+            self._generation += 1
+            if names is None:
+                self._values.clear()
+            else:
+                for name in names:
+                    self._values.pop(name, None)
+
+    def _ttl(self, name):
+        # Fresh and stale periods of an attribute
+        if name in self._pushed:
+            return self.event_timeout, self.event_timeout + self.stale
+        return self.fresh, self.stale
+
+    def _start_flight(self, names):
+        # Must be called with the lock held
+        event = threading.Event()
+        for name in names:
+            self._inflight[name] = event
+        return event, self._generation
+
+    def _read_device(self, names, flight):
+        event, generation = flight
+        try:
+            values = self._reader(names)
+            self.update(names, values, generation)
+            return dict(zip(names, values))
+        finally:
+            with self._lock:
+                for name in names:
+                    if self._inflight.get(name) is event:
+                        del self._inflight[name]
+            event.set()
+
+    def _fetch(self, names):
+        """Read the attributes from the device. The ones already requested
+        by another thread are not requested again, their reply is awaited.
+        """
+        with self._lock:
+            events = {self._inflight[name] for name in names
+                      if name in self._inflight}
+            own = [name for name in names if name not in self._inflight]
+            if own:
+                flight = self._start_flight(own)
+
+        values = self._read_device(own, flight) if own else {}
+        for event in events:
+            event.wait()
+
+        others = [name for name in names if name not in values]
+        if others:
+            now = time.monotonic()
+            with self._lock:
+                for name in others:
+                    entry = self._values.get(name)
+                    if (entry is not None
+                            and now - entry[1] < self._ttl(name)[1]):
+                        values[name] = entry[0]
+            # The request of the other thread failed or was invalidated,
+            # older values are not returned
+            failed = [name for name in others if name not in values]
+            if failed:
+                values.update(zip(failed, self._reader(failed)))
+        return values
+
+    def _refresh(self, names, flight):
+        try:
+            self._read_device(names, flight)
+        except Exception:
+            # The next read of a rotten value will fail synchronously
+            pass
+
+
+class PendingRead(object):
+    """Asynchronous read of Tango attributes whose reply is stored in an
+    AttributeCache once collected.
+
+    It lets a controller issue the request in StateAll and pick it up in
+    StateOne/ReadAll, so the network round trip overlaps the work done by
+    the pool in between.
+    """
+
+    def __init__(self, cache, timeout=500):
+        self._cache = cache
+        self.timeout = timeout
+        self._request = None
+
+    def request(self, device, names):
+        """Issue the read, cancelling a previous one not yet collected."""
+        self.cancel(device)
+        aid = device.read_attributes_asynch(names)
+        self._request = (aid, list(names), self._cache.generation)
+
+    def collect(self, device):
+        """Wait for the pending reply, if any, and store it in the cache."""
+        if self._request is None:
+            return
+        aid, names, generation = self._request
+        self._request = None
+        try:
+            replies = device.read_attributes_reply(aid, self.timeout)
+        except PyTango.DevFailed:
+            # A reply not arrived in time would never be collected
+            self._cancel(device, aid)
+            raise
+        self._cache.update(names, [r.value for r in replies], generation)
+
+    def cancel(self, device):
+        if self._request is not None:
+            aid = self._request[0]
+            self._request = None
+            self._cancel(device, aid)
+
+    def _cancel(self, device, aid):
+        try:
+            device.cancel_asynch_request(aid)
+        except Exception:
+            pass
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+#############################################################################
+##
+## file :    linkam_device.py
+##
+## developers : ctbeamlines@cells.es
+##
+## copyleft :    Cells / Alba Synchrotron
+##               Bellaterra
+##               Spain
+##
+#############################################################################
+##
+## This file is part of Sardana.
+##
+## This is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This software is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, see <http://www.gnu.org/licenses/>.
+###########################################################################
+import time
+import PyTango
+
+
+class LinkamDevice(object):
+    """Connection to the Linkam DS shared by the Linkam controllers.
+
+    The proxy is created on first use of `device`. After a failed
+    connection, accesses fail at once for RECONNECT_PERIOD seconds instead
+    of waiting for a new connection timeout. The controller provides the
+    DeviceName and Timeout properties, EVENT_ATTRS and the `_cache`
+    (AttributeCache) and `_pending` (PendingRead) members.
+    """
+
+    # Seconds before retrying a failed connection to the DS
+    RECONNECT_PERIOD = 5
+
+    def _init_device(self):
+        self._device = None
+        self._connect_retry = 0
+        self._dev_failed = False
+
+    @property
+    def device(self):
+        """Proxy to the DS, connected on first use."""
+        if self._device is None:
+            if time.monotonic() < self._connect_retry:
+                PyTango.Except.throw_exception(
+                    'Linkam_NotConnected',
+                    'Not connected to %s' % self.DeviceName,
+                    self.__class__.__name__)
+            try:
+                self._connect()
+            except PyTango.DevFailed:
+                self._connect_retry = time.monotonic() + self.RECONNECT_PERIOD
+                raise
+        return self._device
+
+    def _connect(self):
+        device = PyTango.DeviceProxy(self.DeviceName)
+        device.set_timeout_millis(self.Timeout)
+        self._setup_device(device)
+        self._device = device
+        self._subscribe()
+
+    def _setup_device(self, device):
+        """Configure a new proxy before it is used."""
+        # Always read from the device, not from the DS polling buffer
+        device.set_source(PyTango.DevSource.DEV)
+
+    def _subscribe(self):
+        errors = self._cache.subscribe(self._device, self.EVENT_ATTRS)
+        for name, e in errors.items():
+            self._log.debug('No change events for %s, polling it: %s'
+                            % (name, e))
+
+    def _resubscribe(self):
+        """Subscribe again to the change events of a connected DS, after
+        the last axis was deleted and a new one is added."""
+        if self._device is not None and not self._cache.subscribed:
+            self._subscribe()
+
+    def _ensure_alive(self):
+        """Drop the DS proxy if the last communication failed and the DS
+        does not answer, so it is reconnected on next use.
+        """
+        if not self._dev_failed or self._device is None:
+            return
+        try:
+            self._device.ping()
+        except PyTango.DevFailed:
+            self._log.warning('Reconnecting to %s' % self.DeviceName)
+            self._pending.cancel(self._device)
+            self._cache.unsubscribe()
+            self._device = None
+            self._connect_retry = time.monotonic() + self.RECONNECT_PERIOD
+        self._dev_failed = False
@@ -1,27 +1,82 @@
+import threading
 import time
-import numpy as np
 import PyTango as tango
 from sardana.macroserver.macro import Macro, Type
 
 LINKAMT95=95
 LINKAMT96=96
 UPDATE_LINE = u'\033[1A\033[K'
+# Temperature commands, their configuration is queried once per device
+RAMP_COMMANDS = ['StartRamp', 'StopRamp', 'HoldTemp']
+# Limits of the temperature polling period during a ramp (seconds)
+MIN_POLL_PERIOD = 0.1
+MAX_POLL_PERIOD = 2.0
+# Minimum changes of temperature (degC) and progress (%) reported by a ramp
+OUTPUT_TEMP_STEP = 0.1
+OUTPUT_PROGRESS_STEP = 1.0
+
+
+# Proxy, model and temperature attribute of each Linkam device already used,
+# by device name, shared by all the macros. Renewed by linkam_set_device.
+_DEV_CACHE = {}
+
+
+def linkam_device(dev_name):
+    """Return the (proxy, model, temperature attribute) of a Linkam
+    device, connecting to it only the first time."""
+    entry = _DEV_CACHE.get(dev_name)
+    if entry is None:
+        proxy = tango.DeviceProxy(dev_name)
+        try:
+            proxy.get_command_config(RAMP_COMMANDS)
+        except tango.DevFailed:
+            pass
+        if "tst_gap" in proxy.get_attribute_list():
+            entry = (proxy, LINKAMT96, "temperature_t96")
+        else:
+            entry = (proxy, LINKAMT95, "Temperature")
+        _DEV_CACHE[dev_name] = entry
+    return entry
+
+
+def ramp_poll_period(temp, target, rate):
+    """Return the time to wait before reading again the temperature of a
+    ramp at `rate` degC/min: a twentieth of the expected remaining time,
+    so the polling gets faster as the target approaches.
+    """
+    if rate == 0:
+        return MIN_POLL_PERIOD
+    remaining = abs(target - temp) / (abs(rate) / 60.0)
+    return min(max(remaining / 20, MIN_POLL_PERIOD), MAX_POLL_PERIOD)
 
 
 class linkam_base(Macro):
     def prepare(self, *args, **kwargs):
         dev_name = self.getEnv("LinkamDevice")
-        self.linkam_dev = tango.DeviceProxy(dev_name)
-        if hasattr(self.linkam_dev, "tst_gap"):
-            self.temperature_attr = "temperature_t96"
-            self.model = LINKAMT96
-        else:
-            self.temperature_attr = "Temperature"
-            self.model = LINKAMT95
+        entry = linkam_device(dev_name)
+        self.linkam_dev, self.model, self.temperature_attr = entry
 
     def get_linkam_temperature(self):
         return self.linkam_dev.read_attribute(self.temperature_attr).value
 
+    def request_linkam_temperature(self):
+        """Start an asynchronous read of the temperature, return the request
+        id to be passed to reply_linkam_temperature."""
+        return self.linkam_dev.read_attribute_asynch(self.temperature_attr)
+
+    def reply_linkam_temperature(self, rid):
+        """Wait for the reply of an asynchronous temperature read."""
+        return self.linkam_dev.read_attribute_reply(rid, 0).value
+
+    def cancel_linkam_temperature(self, rid):
+        """Cancel an asynchronous temperature read not collected."""
+        if rid is None:
+            return
+        try:
+            self.linkam_dev.cancel_asynch_request(rid)
+        except tango.DevFailed:
+            pass
+
 
 class linkam_force_zero(linkam_base):
     """Macro that resets the force to zero in the Linkam Device Server."""
@@ -115,8 +170,8 @@ class linkam_stop(linkam_base):
 
     def run(self):
         self.linkam_dev.command_inout('StopRamp')
-        self.linkam_dev.write_attribute('Pumpspeed', 0)
-        self.linkam_dev.write_attribute('PumpMode', 0)  # Auto
+        # Pump stopped and in automatic mode, in a single request
+        self.linkam_dev.write_attributes([('Pumpspeed', 0), ('PumpMode', 0)])
         self.debug("Linkam temperature ramp stopped. This cuts the power to the heater.")
         self.debug("Linkam LNP (Liquid Nitrogen Pump) mode to automatic and LNP speed to 0.")
 
@@ -127,8 +182,48 @@ class linkam_ramp(linkam_base):
                  ['rate', Type.Float, None, 'Ramp rate (degC/min)']]
 
 
+    def prepare(self, *args, **kwargs):
+        linkam_base.prepare(self, *args, **kwargs)
+        self._event_id = None
+        self._temp_changed = threading.Event()
+        self._last_temp = None
+
     def on_abort(self):
         self.linkam_dev.command_inout('HoldTemp')
+        self._unsubscribe()
+
+    def _on_temp_change(self, event):
+        if not event.err:
+            self._last_temp = event.attr_value.value
+            self._temp_changed.set()
+
+    def _subscribe(self):
+        """Subscribe to the temperature change events. Return False if the
+        DS does not provide them."""
+        try:
+            self._event_id = self.linkam_dev.subscribe_event(
+                self.temperature_attr, tango.EventType.CHANGE_EVENT,
+                self._on_temp_change)
+        except tango.DevFailed:
+            self.debug('No temperature change events, polling it')
+            return False
+        return True
+
+    def _unsubscribe(self):
+        event_id, self._event_id = self._event_id, None
+        if event_id is not None:
+            try:
+                self.linkam_dev.unsubscribe_event(event_id)
+            except tango.DevFailed:
+                pass
+
+    def _wait_temperature(self):
+        """Wait for the next change event of the temperature. If none
+        arrives in MAX_POLL_PERIOD the temperature is read from the DS."""
+        if self._temp_changed.wait(MAX_POLL_PERIOD):
+            self._temp_changed.clear()
+            return self._last_temp
+        return self.get_linkam_temperature()
 
     def run(self, target, rate, output_block=True):
         self.info('Running Linkam ramp')
@@ -139,20 +234,36 @@ class linkam_ramp(linkam_base):
         args = (rate, target)
         self.linkam_dev.command_inout('StartRamp', args)
 
-        temp, t0 = tempi, ''
-        while ((target > temp and rampup) or
-               (target < temp and not rampup)):
-            time.sleep(0.1)
-            temp = self.get_linkam_temperature()
-            progress = 100 * (temp - tempi) / (target - tempi)
-            yield progress if progress < 100 else 100
-            if output_block:
-                if temp != t0:
-                    self.info(
-                        UPDATE_LINE + 'Linkam Temperature: %.2f degC [Progress: %.1f%%]' % (
-                        temp, progress))
-                    t0 = temp
-            self.checkPoint()
+        temp, t0, p0 = tempi, None, None
+        # The temperature is updated by its change events when the DS
+        # provides them. Otherwise the next read is in flight while the
+        # progress is reported and the macro sleeps
+        events = self._subscribe()
+        rid = None
+        try:
+            if not events:
+                rid = self.request_linkam_temperature()
+            while ((target > temp and rampup) or
+                   (target < temp and not rampup)):
+                if events:
+                    temp = self._wait_temperature()
+                else:
+                    time.sleep(ramp_poll_period(temp, target, rate))
+                    temp = self.reply_linkam_temperature(rid)
+                    rid = self.request_linkam_temperature()
+                progress = 100 * (temp - tempi) / (target - tempi)
+                yield progress if progress < 100 else 100
+                if output_block:
+                    if (t0 is None or abs(temp - t0) >= OUTPUT_TEMP_STEP
+                            or abs(progress - p0) >= OUTPUT_PROGRESS_STEP):
+                        self.info(
+                            UPDATE_LINE + 'Linkam Temperature: %.2f degC [Progress: %.1f%%]' % (
+                            temp, progress))
+                        t0, p0 = temp, progress
+                self.checkPoint()
+        finally:
+            self.cancel_linkam_temperature(rid)
+            self._unsubscribe()
         self.info(UPDATE_LINE + 'Linkam is holding at %s degC' % target)
 
 
@@ -166,6 +277,8 @@ class linkam_ramp_old(linkam_base):
         self.linkam_dev.command_inout('HoldTemp')
 
     def run(self, rate, temperature, pump_profile):
+        # Only needed for the pump profiles, not imported with the module
+        import numpy as np
         # initial temperature
         tempi = self.get_linkam_temperature()
         rampup = temperature > tempi
@@ -175,14 +288,14 @@ class linkam_ramp_old(linkam_base):
         # during the ramp.
         # Here the profile data is loaded from the file into T and P tables
         if pumpDynamic:
-            pumpFile = file(pump_profile)
-            lines = pumpFile.readlines()
-            pumpFile.close()
-            self.T_table, self.P_table = [], []
-            for line in lines[1:]:
-                val = list(map(float, line.split()))
-                self.T_table.append(val[0])
-                self.P_table.append(val[1])
+            # The first line of the file is a header
+            T_table, P_table = np.loadtxt(pump_profile, skiprows=1,
+                                          usecols=(0, 1), ndmin=2,
+                                          unpack=True)
+            # np.interp needs increasing temperatures
+            order = np.argsort(T_table)
+            self.T_table = T_table[order]
+            self.P_table = P_table[order]
             if rampup:
                 self.linkam_dev.write_attribute('Pumpspeed', 0)
 
@@ -190,23 +303,35 @@ class linkam_ramp_old(linkam_base):
         self.linkam_dev.command_inout('StartRamp', args)
 
         temp = tempi
-        while ((temperature > temp and rampup) or
-               (temperature < temp and not rampup)):
-            time.sleep(0.1)
-            temp = self.get_linkam_temperature()
-            # The pump speed will be interpolated from the values given in the
-            # pump profile file. Only for ramp down. In ramp ups the pump is off
-            if pumpDynamic and not rampup:
-                pump = np.interp(temp, self.T_table, self.P_table)
-                self.linkam_dev.write_attribute('Pumpspeed', int(pump))
-
-            progress = 100 * (temp - tempi) / (temperature - tempi)
-            yield progress if progress < 100 else 100
-            self.checkPoint()
+        # Pump speed last written, it is only written again when it changes
+        last_pump = 0 if pumpDynamic and rampup else None
+        rid = self.request_linkam_temperature()
+        try:
+            while ((temperature > temp and rampup) or
+                   (temperature < temp and not rampup)):
+                time.sleep(0.1)
+                temp = self.reply_linkam_temperature(rid)
+                rid = self.request_linkam_temperature()
+                # The pump speed will be interpolated from the values given in
+                # the pump profile file. Only for ramp down. In ramp ups the
+                # pump is off
+                if pumpDynamic and not rampup:
+                    pump = int(np.interp(temp, self.T_table, self.P_table))
+                    if pump != last_pump:
+                        self.linkam_dev.write_attribute('Pumpspeed', pump)
+                        last_pump = pump
+
+                progress = 100 * (temp - tempi) / (temperature - tempi)
+                yield progress if progress < 100 else 100
+                self.checkPoint()
+        finally:
+            # The read issued after the last reply is never collected
+            self.cancel_linkam_temperature(rid)
 
         if pumpDynamic:
-            pump = np.interp(temp, self.T_table, self.P_table)
-            self.linkam_dev.write_attribute('Pumpspeed', int(pump))
+            pump = int(np.interp(temp, self.T_table, self.P_table))
+            if pump != last_pump:
+                self.linkam_dev.write_attribute('Pumpspeed', pump)
 
 
 class linkam_set_device(Macro):
@@ -215,7 +340,9 @@ class linkam_set_device(Macro):
 
     def run(self, device):
         try:
-            ds = tango.DeviceProxy(device)
+            # Connect again, the new proxy is then used by the other macros
+            _DEV_CACHE.pop(device, None)
+            ds, _, _ = linkam_device(device)
             self.debug("Device %s is %s" % (device, str(ds.state())))
             self.execMacro('senv LinkamDevice %s' % device)
         except Exception as error:
@@ -0,0 +1,215 @@
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+try:
+    from sardana_linkam.ctrl import linkam_cache
+    from sardana_linkam.ctrl.linkam_cache import AttributeCache, PendingRead
+except ImportError:
+    # PyTango is not installed
+    linkam_cache = None
+
+
+class Clock(object):
+    """Monotonic clock advanced by hand."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class FakeReader(object):
+    """Reader returning the current value of each attribute. When blocking,
+    each read waits until release() is called."""
+
+    def __init__(self, values, blocking=False):
+        self.values = dict(values)
+        self.calls = []
+        # Exceptions raised by the next reads, in order
+        self.errors = []
+        self.started = threading.Event()
+        self._gate = threading.Event()
+        if not blocking:
+            self._gate.set()
+
+    def __call__(self, names):
+        self.calls.append(list(names))
+        self.started.set()
+        self._gate.wait(5)
+        if self.errors:
+            raise self.errors.pop(0)
+        return [self.values[name] for name in names]
+
+    def block(self):
+        self.started.clear()
+        self._gate.clear()
+
+    def release(self):
+        self._gate.set()
+
+
+class Reply(object):
+
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeDevice(object):
+    """Device answering read_attributes_asynch with the given values."""
+
+    def __init__(self, values):
+        self.values = dict(values)
+        self._requests = {}
+
+    def read_attributes_asynch(self, names):
+        aid = len(self._requests) + 1
+        self._requests[aid] = [Reply(self.values[name]) for name in names]
+        return aid
+
+    def read_attributes_reply(self, aid, timeout):
+        return self._requests.pop(aid)
+
+    def cancel_asynch_request(self, aid):
+        self._requests.pop(aid, None)
+
+
+@unittest.skipIf(linkam_cache is None, 'PyTango is not installed')
+class AttributeCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(
+            linkam_cache, 'time', types.SimpleNamespace(monotonic=self.clock))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def wait_idle(self, cache, name):
+        # Wait for the background refresh of an attribute to end
+        deadline = time.time() + 5
+        while name in cache._inflight and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertNotIn(name, cache._inflight)
+
+    def test_fresh_read(self):
+        reader = FakeReader({'A': 1})
+        cache = AttributeCache(reader, fresh=0.1, stale=1.0)
+        self.assertEqual(cache.read(['A']), [1])
+        reader.values['A'] = 2
+        self.clock.advance(0.05)
+        self.assertEqual(cache.read(['A']), [1])
+        self.assertEqual(len(reader.calls), 1)
+
+    def test_stale_read(self):
+        reader = FakeReader({'A': 1})
+        cache = AttributeCache(reader, fresh=0.1, stale=1.0)
+        cache.read(['A'])
+        reader.values['A'] = 2
+        self.clock.advance(0.5)
+        # The old value is returned and refreshed in the background
+        self.assertEqual(cache.read(['A']), [1])
+        self.wait_idle(cache, 'A')
+        self.assertEqual(len(reader.calls), 2)
+        self.assertEqual(cache.read(['A']), [2])
+
+    def test_rotten_read(self):
+        reader = FakeReader({'A': 1})
+        cache = AttributeCache(reader, fresh=0.1, stale=1.0)
+        cache.read(['A'])
+        reader.values['A'] = 2
+        self.clock.advance(1.0)
+        self.assertTrue(cache.needs_read(['A']))
+        self.assertEqual(cache.read(['A']), [2])
+        self.assertEqual(len(reader.calls), 2)
+
+    def test_concurrent_reads_share_request(self):
+        reader = FakeReader({'A': 1}, blocking=True)
+        cache = AttributeCache(reader)
+        results = []
+
+        def read():
+            results.append(cache.read(['A']))
+
+        threads = [threading.Thread(target=read) for _ in range(2)]
+        threads[0].start()
+        self.assertTrue(reader.started.wait(5))
+        threads[1].start()
+        time.sleep(0.05)
+        reader.release()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, [[1], [1]])
+        self.assertEqual(len(reader.calls), 1)
+
+    def test_failed_shared_request_is_read_again(self):
+        reader = FakeReader({'A': 1})
+        cache = AttributeCache(reader, fresh=0.1, stale=1.0)
+        cache.read(['A'])
+        reader.values['A'] = 2
+        reader.errors.append(RuntimeError('DS failure'))
+        reader.block()
+        self.clock.advance(5.0)
+        results = []
+
+        def read():
+            try:
+                results.append(cache.read(['A']))
+            except RuntimeError:
+                pass
+
+        threads = [threading.Thread(target=read) for _ in range(2)]
+        threads[0].start()
+        self.assertTrue(reader.started.wait(5))
+        threads[1].start()
+        time.sleep(0.05)
+        reader.release()
+        for thread in threads:
+            thread.join(5)
+        # The rotten value left by the failed request is not returned
+        self.assertEqual(results, [[2]])
+
+    def test_invalidate_discards_refresh_in_flight(self):
+        reader = FakeReader({'A': 1})
+        cache = AttributeCache(reader, fresh=0.1, stale=1.0)
+        cache.read(['A'])
+        reader.values['A'] = 2
+        reader.block()
+        self.clock.advance(0.5)
+        self.assertEqual(cache.read(['A']), [1])
+        self.assertTrue(reader.started.wait(5))
+        cache.invalidate()
+        reader.release()
+        self.wait_idle(cache, 'A')
+        self.assertTrue(cache.needs_read(['A']))
+
+
+@unittest.skipIf(linkam_cache is None, 'PyTango is not installed')
+class PendingReadTestCase(unittest.TestCase):
+
+    def test_collect_stores_reply(self):
+        cache = AttributeCache(FakeReader({}))
+        device = FakeDevice({'A': 1})
+        pending = PendingRead(cache)
+        pending.request(device, ['A'])
+        pending.collect(device)
+        self.assertFalse(cache.needs_read(['A']))
+        self.assertEqual(cache.read(['A']), [1])
+
+    def test_collect_drops_older_generation(self):
+        cache = AttributeCache(FakeReader({}))
+        device = FakeDevice({'A': 1})
+        pending = PendingRead(cache)
+        pending.request(device, ['A'])
+        cache.invalidate()
+        pending.collect(device)
+        self.assertTrue(cache.needs_read(['A']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,243 @@
+import unittest
+from unittest import mock
+
+try:
+    import PyTango
+    from sardana import State
+    from sardana_linkam.ctrl.LinkamT96MotorCtrl import LinkamT96MotorCtrl
+    from sardana_linkam.ctrl.LinkamTST350MotorCtrl import \
+        LinkamTST350MotorCtrl
+    from sardana_linkam.ctrl.LinkamTST350TempMotorCtrl import \
+        LinkamTST350TempMotorCtrl
+except ImportError:
+    # sardana, PyTango or numpy are not installed
+    PyTango = None
+
+
+class Reply(object):
+
+    def __init__(self, value, w_value=None):
+        self.value = value
+        self.w_value = w_value
+
+
+class FakeDevice(object):
+    """DeviceProxy of a DS without change events. Every call reaching the
+    DS is recorded in `calls`."""
+
+    def __init__(self, values):
+        self.values = dict(values)
+        self.calls = []
+        # Exceptions raised by command_inout_reply, by command name
+        self.reply_errors = {}
+        # Exceptions raised by command_inout, by command name
+        self.command_errors = {}
+        self._requests = {}
+        self._next_id = 1
+
+    def _store(self, request):
+        aid = self._next_id
+        self._next_id += 1
+        self._requests[aid] = request
+        return aid
+
+    def set_source(self, source):
+        pass
+
+    def set_timeout_millis(self, timeout):
+        pass
+
+    def get_command_config(self, names):
+        pass
+
+    def subscribe_event(self, name, event_type, callback):
+        PyTango.Except.throw_exception(
+            'API_EventPropertiesNotSet', 'No events', 'FakeDevice')
+
+    def read_attribute(self, name):
+        self.calls.append(('read_attribute', name))
+        value = self.values[name]
+        return Reply(value, value)
+
+    def read_attributes(self, names):
+        self.calls.append(('read_attributes', list(names)))
+        return [Reply(self.values[name]) for name in names]
+
+    def read_attributes_asynch(self, names):
+        self.calls.append(('read_attributes_asynch', list(names)))
+        return self._store([Reply(self.values[name]) for name in names])
+
+    def read_attributes_reply(self, aid, timeout):
+        return self._requests.pop(aid)
+
+    def write_attribute(self, name, value):
+        self.calls.append(('write_attribute', name, value))
+        self.values[name] = value
+
+    def command_inout(self, name, *args):
+        self.calls.append(('command_inout', name) + args)
+        if name in self.command_errors:
+            raise self.command_errors[name]
+
+    def command_inout_asynch(self, name, arg):
+        self.calls.append(('command_inout_asynch', name, arg))
+        return self._store(name)
+
+    def command_inout_reply(self, aid, timeout):
+        name = self._requests[aid]
+        self.calls.append(('command_inout_reply', name))
+        error = self.reply_errors.get(name)
+        if error is None:
+            del self._requests[aid]
+        else:
+            raise error
+
+    def cancel_asynch_request(self, aid):
+        self.calls.append(('cancel_asynch_request', self._requests[aid]))
+        del self._requests[aid]
+
+
+def dev_failed(reason):
+    try:
+        PyTango.Except.throw_exception(reason, reason, 'FakeDevice')
+    except PyTango.DevFailed as e:
+        return e
+
+
+@unittest.skipIf(PyTango is None, 'sardana, PyTango or numpy missing')
+class ControllerTestCase(unittest.TestCase):
+
+    def connect(self, klass, values, **props):
+        """Return a controller of the given class connected to a fake
+        device with the given attribute values."""
+        self.device = FakeDevice(values)
+        patcher = mock.patch.object(PyTango, 'DeviceProxy',
+                                    return_value=self.device)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        props.update(DeviceName='test/linkam/1', Timeout=500)
+        ctrl = klass('test', props)
+        ctrl._log = mock.Mock()
+        return ctrl
+
+    def commands(self):
+        return [call for call in self.device.calls
+                if call[0].startswith('command_inout')]
+
+
+class LinkamTST350TempMotorCtrlTestCase(ControllerTestCase):
+
+    def setUp(self):
+        self.ctrl = self.connect(
+            LinkamTST350TempMotorCtrl,
+            {'IdleT': True, 'ErrorMsg': 'No_error', 'Program': 'Holding',
+             'Temperature': 25.0},
+            CacheTTL=0.2, UsePollingCache=False)
+        self.ctrl.AddDevice(1)
+
+    def state(self):
+        self.ctrl.StateAll()
+        return self.ctrl.StateOne(1)
+
+    def test_state_on(self):
+        self.assertEqual(self.state(), (State.On, 'Holding'))
+        self.assertFalse(self.ctrl._dev_failed)
+        self.ctrl._log.error.assert_not_called()
+
+    def test_state_moving(self):
+        self.device.values['IdleT'] = False
+        self.assertEqual(self.state(), (State.Moving, 'Holding'))
+        self.assertFalse(self.ctrl._dev_failed)
+        self.ctrl._log.error.assert_not_called()
+
+
+class LinkamTST350MotorCtrlTestCase(ControllerTestCase):
+
+    def setUp(self):
+        self.ctrl = self.connect(
+            LinkamTST350MotorCtrl,
+            {'Idle': [False, False, False], 'PositionX': 1,
+             'PositionY': 7, 'PositionZ': 3})
+        for axis in (1, 2, 3):
+            self.ctrl.AddDevice(axis)
+
+    def test_start_all_steps(self):
+        self.ctrl.SetAxisPar(1, 'step_per_unit', 10)
+        self.ctrl.SetAxisPar(3, 'step_per_unit', 100)
+        self.ctrl.PreStartAll()
+        self.ctrl.StartOne(1, 1.5)
+        self.ctrl.StartOne(3, 2.0)
+        self.ctrl.StartAll()
+        # The axis not moved keeps its position, in steps
+        self.assertIn(('read_attributes', ['PositionY']), self.device.calls)
+        self.assertIn(('command_inout', 'MoveAbsolute', [15, 7, 200]),
+                      self.device.calls)
+
+    def test_speeds_flushed_once(self):
+        self.ctrl.SetAxisPar(1, 'velocity', 2)
+        self.ctrl.SetAxisPar(2, 'velocity', 3)
+        self.ctrl.SetAxisPar(3, 'velocity', 4)
+        self.assertEqual(self.device.calls, [])
+        self.ctrl.PreStartAll()
+        # X and Y share the speed, the last one set is written
+        self.assertEqual(self.device.calls,
+                         [('command_inout', 'SetSpeedXY', 3),
+                          ('write_attribute', 'SpeedZ', 4)])
+        self.ctrl.PreStartAll()
+        self.assertEqual(len(self.device.calls), 2)
+
+    def test_failed_speed_kept(self):
+        self.ctrl.SetAxisPar(1, 'velocity', 2)
+        self.ctrl.SetAxisPar(3, 'velocity', 4)
+        self.device.command_errors['SetSpeedXY'] = dev_failed('Failed')
+        with self.assertRaises(PyTango.DevFailed):
+            self.ctrl.PreStartAll()
+        del self.device.command_errors['SetSpeedXY']
+        self.ctrl.PreStartAll()
+        self.assertEqual(self.device.calls[-2:],
+                         [('command_inout', 'SetSpeedXY', 2),
+                          ('write_attribute', 'SpeedZ', 4)])
+
+
+class LinkamT96MotorCtrlTestCase(ControllerTestCase):
+
+    def setUp(self):
+        self.ctrl = self.connect(
+            LinkamT96MotorCtrl,
+            {'tst_stretching': False, 'heater_state': 'Holding',
+             'tst_gap': 10.0, 'temperature_t96': 25.0})
+        self.ctrl.AddDevice(1)
+        self.ctrl.AddDevice(2)
+        self.ctrl.SetAxisPar(1, 'step_per_unit', 2)
+
+    def start(self):
+        self.ctrl.PreStartAll()
+        self.ctrl.StartOne(1, 5)
+        self.ctrl.StartOne(2, 30)
+        # Nothing is sent before StartAll
+        self.assertEqual(self.commands(), [])
+        self.ctrl.StartAll()
+
+    def test_commands_sent_before_replies(self):
+        self.start()
+        self.assertEqual(
+            self.commands(),
+            [('command_inout_asynch', 'MoveGapAbsolute', 10.0),
+             ('command_inout_asynch', 'StartTemperatureRamp', 30),
+             ('command_inout_reply', 'MoveGapAbsolute'),
+             ('command_inout_reply', 'StartTemperatureRamp')])
+
+    def test_failed_reply_collects_the_others(self):
+        error = dev_failed('Failed')
+        self.device.reply_errors['MoveGapAbsolute'] = error
+        with self.assertRaises(PyTango.DevFailed) as context:
+            self.start()
+        self.assertIs(context.exception, error)
+        self.assertIn(('cancel_asynch_request', 'MoveGapAbsolute'),
+                      self.device.calls)
+        self.assertIn(('command_inout_reply', 'StartTemperatureRamp'),
+                      self.device.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()